@@ -4,4 +4,4 @@ Copyright (c) 2019 Cerebras Systems Inc.
 All rights reserved.
 """
 from .online_norm_1d import ControlNorm1DLoop, ControlNorm1D, OnlineNorm1D, LayerScaling1D
-from .online_norm_2d import ControlNorm2DLoop, ControlNorm2D, OnlineNorm2D, LayerScaling
+from .online_norm_2d import ControlNorm2DLoop, ControlNorm2D, SyncControlNorm2D, OnlineNorm2D, LayerScaling
@@ -7,9 +7,12 @@ All rights reserved.
 This module implements the Online Normalization algorithm and the components
 which go into it.
 """
+import contextlib
+import functools
 import warnings
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 
 
@@ -25,7 +28,7 @@ class LayerScaling(nn.Module):
 
     Shape:
         - Input: :math:`(N, C, H, W)`
-        - Output: :math:`(N, C, H, W)` (same shape as input)
+        - Output: :math:`(N, C, H, W)` (same shape and memory format as input)
 
     Examples::
 
@@ -42,13 +45,27 @@ class LayerScaling(nn.Module):
         return f'eps={self.eps}'
 
     def forward(self, input):
-        # calculate second moment
-        rank = input.dim()
-        tmp = input.view(input.size(0), -1)
-        moment2 = torch.mean(tmp * tmp, dim=1, keepdim=True)
-        for _ in range(rank - 2): moment2 = moment2.unsqueeze(-1)
-        # divide out second moment
-        return input / torch.sqrt(moment2 + self.eps)
+        # calculate second moment in a single reduction pass
+        # reducing in place of flattening keeps strided inputs from being copied
+        dim = tuple(range(1, input.dim()))
+        n = input.numel() // input.size(0)
+        # accumulate in at least float32 and scale to the rms before squaring
+        # so that reduced precision inputs can not overflow
+        acc_dtype = torch.promote_types(input.dtype, torch.float32)
+        rms = torch.linalg.vector_norm(input, dim=dim, keepdim=True,
+                                       dtype=acc_dtype) / n ** 0.5
+        moment2 = rms * rms
+        # scale out second moment in a single pointwise pass
+        return input * torch.rsqrt(moment2 + self.eps).to(input.dtype)
+
+
+def channel_view(x):
+    """
+    View per channel values of size :math:`(C)` or :math:`(N, C)` as
+    :math:`(N, C, 1, 1)` so they broadcast against an :math:`(N, C, H, W)`
+    input. Returns a view sharing storage with x.
+    """
+    return x.view(-1, x.size(-1), 1, 1)
 
 
 class ControlNorm2DLoop(nn.Module):
@@ -77,7 +94,7 @@ class ControlNorm2DLoop(nn.Module):
 
     Shape:
         - Input: :math:`(N, C, H, W)`
-        - Output: :math:`(N, C, H, W)` (same shape as input)
+        - Output: :math:`(N, C, H, W)` (same shape and memory format as input)
 
     Examples::
 
@@ -110,51 +127,60 @@ class ControlNorm2DLoop(nn.Module):
             @staticmethod
             def forward(ctx, input):
                 afwd = self.afwd
-                out = torch.empty_like(input)
-                scale = torch.empty_like(input[:, :, 0, 0])
 
                 mu, var = self.moments(input)
 
-                for idx in range(input.size(0)):
-                    # fprop activations
-                    scale[idx] = torch.sqrt(self.var + self.eps).clone()
-                    _mu = self.m.unsqueeze(-1).unsqueeze(-1)
-                    _stddev = scale[idx].unsqueeze(-1).unsqueeze(-1)
-                    out[idx] = (input[idx] - _mu) / _stddev
-
-                    # Update statistics trackers
-                    self.var.data = (afwd * self.var +
-                                     (1 - afwd) * var[idx] +
-                                     (afwd * (1 - afwd) *
-                                      (mu[idx] - self.m) ** 2))
-                    self.m.data.add_((1 - afwd) * (mu[idx] - self.m))
-
-                # save for backwards
-                ctx.save_for_backward(out.clone(), scale.clone())
+                # streaming statistics seen by each sample and after each sample
+                _mu, mu_stream = lin_ema(mu, self.m, afwd, 1 - afwd)
+                var_current = var + afwd * (mu - _mu) ** 2
+                _var, var_stream = lin_ema(var_current, self.var,
+                                           afwd, 1 - afwd)
+
+                # fprop activations
+                rscale = torch.rsqrt(_var + self.eps)
+                out = normalize(input, channel_view(_mu), channel_view(rscale))
+
+                # Update statistics trackers
+                self.m.copy_(mu_stream[-1])
+                self.var.copy_(var_stream[-1])
+
+                # save for backwards; out is also returned so it is cloned to
+                # allow in-place ops (e.g. ReLU(inplace=True)) on the output
+                ctx.save_for_backward(out.clone(), rscale)
                 return out
 
             @staticmethod
             def backward(ctx, grad_out):
-                out, scale, = ctx.saved_tensors
-                abkw = self.abkw
-                grad_in = torch.empty_like(grad_out)
+                # backward may be run inside an autocast region on cpu
+                with no_autocast(grad_out.device.type):
+                    return ControlNormalization.control(ctx, grad_out)
 
-                for idx in range(grad_out.size(0)):
-                    # ctrl grad_out with v controller
-                    grad_v_ctrl = (grad_out[idx] -
-                                   (1 - abkw) * self.v.unsqueeze(-1).unsqueeze(-1) * out[idx])
+            @staticmethod
+            def control(ctx, grad_out):
+                out, rscale, = ctx.saved_tensors
+                abkw = self.abkw
+                dtype = grad_out.dtype
 
-                    # update v control variable
-                    self.v.data.add_(self.mean(grad_v_ctrl * out[idx]))
+                # ctrl grad_out with v controller
+                # v_t = (1 - (1 - abkw) * E[y_t^2]) * v_{t-1} + E[dy_t * y_t]
+                alpha = 1 - (1 - abkw) * self.mean(out * out, dim=(2, 3))
+                beta = self.mean(grad_out * out, dim=(2, 3))
+                _v, v_stream = lin_scan(alpha, beta, self.v, eps=1e-5)
+                grad_v_ctrl = (grad_out -
+                               (1 - abkw) * channel_view(_v.to(dtype)) * out)
 
-                    # scale delta
-                    grad_scaled = grad_v_ctrl / scale[idx].unsqueeze(-1).unsqueeze(-1)
+                # scale delta
+                grad_scaled = grad_v_ctrl * channel_view(rscale.to(dtype))
 
-                    # ctrl grad_scaled with u controller
-                    grad_in[idx] = grad_scaled - (1 - abkw) * self.u.unsqueeze(-1).unsqueeze(-1)
+                # ctrl grad_scaled with u controller
+                # u_t = abkw * u_{t-1} + E[grad_scaled_t]
+                _u, u_stream = lin_ema(self.mean(grad_scaled, dim=(2, 3)),
+                                       self.u, abkw, 1)
+                grad_in = grad_scaled - (1 - abkw) * channel_view(_u.to(dtype))
 
-                    # Update control variables
-                    self.u.data.add_(self.mean(grad_in[idx]))
+                # Update control variables
+                self.v.copy_(v_stream[-1])
+                self.u.copy_(u_stream[-1])
 
                 return grad_in
 
@@ -167,16 +193,14 @@ class ControlNorm2DLoop(nn.Module):
         nn.init.constant_(self.v, 0)
 
     def moments(self, inputs):
-        n = inputs.size(2) * inputs.size(3)
-
-        mu = torch.sum(inputs, dim=(2, 3), keepdim=True) / n
-        mu0 = inputs - mu
-        return (mu.squeeze(),
-                torch.sum(mu0 * mu0, dim=(2, 3), keepdim=False) / n)
+        # single pass Welford reduction over (H, W), stable for large H * W
+        # statistics are gathered in the precision of the streaming state
+        var, mu = torch.var_mean(inputs.to(self.var.dtype), dim=(2, 3),
+                                 correction=0)
+        return mu, var
 
     def mean(self, inputs, dim=(1, 2)):
-        n = inputs.size(dim[0]) * inputs.size(dim[1])
-        return torch.sum(inputs, dim=dim, keepdim=False) / n
+        return torch.mean(inputs, dim=dim, dtype=self.var.dtype)
 
     def extra_repr(self):
         s = (f'num_features={self.num_features}, afwd={self.afwd}, '
@@ -185,10 +209,32 @@ class ControlNorm2DLoop(nn.Module):
 
     def forward(self, input):
         if self.training:
-            return self.normalizer(input)
-        mu = self.m.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-        var = self.var.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-        return (input - mu) / torch.sqrt(var + self.eps)
+            # keep autocast from lowering the precision of the statistics;
+            # activations are processed in the dtype of the input
+            with no_autocast(input.device.type):
+                return self.normalizer(input)
+        mu = channel_view(self.m)
+        var = channel_view(self.var)
+        return normalize(input, mu, torch.rsqrt(var + self.eps))
+
+
+def shift_stream(x_prev, curr):
+    """
+    Helper function for shifting streamed statistics one step back in time,
+    i.e. the statistic each step of the batch sees before its own update.
+    Writes x_prev followed by curr[:-1] into one new tensor.
+
+    Arguments:
+        x_prev: statistic before the first step of size :math:`(L)`
+        curr: statistic after each step of size :math:`(N, L)`
+
+    Return:
+        statistic before each step of size :math:`(N, L)`
+    """
+    stale = curr.new_empty(curr.shape)
+    stale[0].copy_(x_prev)
+    stale[1:].copy_(curr[:-1])
+    return stale
 
 
 def lin_momentum(mu_prev, mu_curr, mu_stream,
@@ -210,27 +256,74 @@ def lin_momentum(mu_prev, mu_curr, mu_stream,
         updated mu_stream (current): to cache for next iteration
     """
     input = torch.cat([mu_prev[1:], mu_curr]).transpose(0, 1).unsqueeze(1)
-    tmp = torch.nn.functional.conv1d(input, momentum_pow).squeeze().transpose(0, 1)
+    tmp = torch.nn.functional.conv1d(input, momentum_pow).view(
+        mu_curr.size(1), mu_curr.size(0)).t()
     curr = (momentum_batch * mu_stream + (1 - momentum) * tmp)
 
-    return torch.cat([mu_stream[-1].unsqueeze(0), curr[:-1]]), curr
+    return shift_stream(mu_stream[-1], curr), curr
 
 
-def conv_alongb_w1(input, b, c):
+def lin_ema(x, x_stream, momentum, gain):
     """
-    helper functions for fast lin_crtls
-    Convolve along 2b dimension with a b length vector of 1's
+    Helper function for unrolling the exponential moving average, ema,
+    x_stream_t = momentum * x_stream_{t-1} + gain * x_t
+    over every step of the batch with a single causal convolution.
 
-    assumes order (b, 2b, c)
+    Arguments:
+        x: this time steps statistic of size :math:`(N, L)`
+        x_stream: ema from last time step of size :math:`(L)`
+        momentum: decay factor of streaming process
+        gain: factor by which each new statistic enters the ema
+
+    Return:
+        ema before each step (stale): to use for fprop
+        ema after each step (current)
     """
-    input = input.transpose(0, 1).clone().view(2 * b, -1).t().unsqueeze(1)
-    tmp = torch.nn.functional.conv1d(input, torch.ones_like(input[0:1, 0:1, :b]))
-    return tmp.squeeze().t().view(b + 1, b, c).clone().transpose(0, 1)
+    n = x.size(0)
+    range_n = torch.arange(n - 1, -1, -1, dtype=x.dtype, device=x.device)
+    momentum_pow = (momentum ** range_n).view(1, 1, -1)
+    tmp = torch.nn.functional.conv1d(x.t().unsqueeze(1), momentum_pow,
+                                     padding=n - 1)[:, 0, :n].t()
+    decay = (momentum ** (range_n.flip(0) + 1)).unsqueeze(-1)
+    curr = decay * x_stream + gain * tmp
 
+    return shift_stream(x_stream, curr), curr
 
-def mean_tensor(input, norm_ax, keepdim=True):
+
+def lin_scan(alpha, beta, x_stream, eps=1e-32):
     """
-    outputs the mean of a pytorch tensor object along axis
+    Helper function for unrolling the linear recurrence
+    x_stream_t = alpha_t * x_stream_{t-1} + beta_t
+    with a time varying decay factor over every step of the batch. Running
+    products of alpha are formed in log space.
+
+    Arguments:
+        alpha: decay factor of each step of size :math:`(N, L)`
+        beta: input of each step of size :math:`(N, L)`
+        x_stream: state from last time step of size :math:`(L)`
+        eps: eps by which to clip alpha which gets log applied to it.
+            Default: 1e-32
+
+    Return:
+        state before each step (stale)
+        state after each step (current)
+    """
+    n = alpha.size(0)
+    # cs[t] = sum(log(alpha[:t + 1]))
+    cs = torch.log(torch.clamp(alpha, min=eps)).cumsum(0)
+    # weight of beta_s in x_stream_t is prod(alpha[s + 1:t + 1]) for s <= t
+    causal = torch.ones(n, n, dtype=torch.bool, device=alpha.device).tril()
+    log_w = (cs.unsqueeze(1) - cs.unsqueeze(0)).masked_fill(
+        ~causal.unsqueeze(-1), float('-inf'))
+    curr = torch.exp(cs) * x_stream + (torch.exp(log_w) * beta).sum(1)
+
+    return shift_stream(x_stream, curr), curr
+
+
+def mean_tensor(input, norm_ax, keepdim=True, dtype=None):
+    """
+    outputs the mean of a pytorch tensor object along axis, accumulated and
+    returned in dtype if given
     """
     assert isinstance(norm_ax, (tuple, int)), f'norm_ax must be a tuple or int, {norm_ax} is a {type(norm_ax)}'
     dims = input.size()
@@ -241,7 +334,7 @@ def mean_tensor(input, norm_ax, keepdim=True):
         n = 1
         for d in norm_ax: n *= dims[d]
 
-    mu = torch.sum(input, dim=norm_ax, keepdim=keepdim) / n
+    mu = torch.sum(input, dim=norm_ax, keepdim=keepdim, dtype=dtype) / n
 
     return mu
 
@@ -250,7 +343,7 @@ def lin_crtl(delta, out, b_size, num_features, v_p, alpha_p, beta_p,
              abkw, eps=1e-32):
     """
     Helper function for controlling with v controller using
-    convolutions which can be distributed across compute fabric.
+    log space running products which can be distributed across compute fabric.
 
     Arguments:
         delta: grad_out
@@ -272,41 +365,100 @@ def lin_crtl(delta, out, b_size, num_features, v_p, alpha_p, beta_p,
     """
 
     # expect 0 << alpha ~<1 so we can move it to log space
-    alpha = (torch.ones_like(delta[:, :, 0, 0]) -
+    alpha = (torch.ones_like(v_p) -
              (1 - abkw) * mean_tensor(out * out,
                                       norm_ax=(2, 3),
-                                      keepdim=True).view(b_size,
-                                                         num_features))
+                                      keepdim=True,
+                                      dtype=v_p.dtype).view(b_size,
+                                                            num_features))
     alpha = torch.clamp(alpha, min=eps)
-    beta = mean_tensor(delta * out,
-                       norm_ax=(2, 3), keepdim=True).view(b_size, num_features)
+    beta = mean_tensor(delta * out, norm_ax=(2, 3), keepdim=True,
+                       dtype=v_p.dtype).view(b_size, num_features)
 
     alpha2log = torch.log(torch.cat((alpha_p, alpha), 0))
     beta2 = torch.cat((beta_p, beta), 0)
 
-    alpha2logcir = alpha2log.repeat(2 * b_size + 1, 1).view(2 * b_size,
-                                                            2 * b_size + 1,
-                                                            num_features)[1:b_size + 1,
-                                                                          :b_size]
-    alpha2logcir2 = torch.cat((alpha2logcir,
-                               torch.zeros_like(alpha2logcir)), 1)
-    alpha2logcir2conv = conv_alongb_w1(alpha2logcir2, b_size, num_features)
-    weight_d = torch.exp(alpha2logcir2conv)
+    # cs[k] = sum(alpha2log[:k]) so prod(alpha2[j:k]) = exp(cs[k] - cs[j])
+    cs = torch.cat((torch.zeros_like(alpha2log[:1]), alpha2log.cumsum(0)), 0)
 
-    beta2cir = beta2.repeat(2 * b_size + 1, 1).view(2 * b_size,
-                                                    2 * b_size + 1,
-                                                    num_features)[1:b_size + 1,
-                                                                  :b_size]
-    v_prev = torch.cat((v_p.reshape(b_size, 1, num_features), beta2cir), 1)
+    # v_new[i] restarts the recursion v = alpha * v + beta from v_p[i] and
+    # steps through alpha2, beta2 over the window i + 1, ..., i + b_size
+    cs_end = cs[b_size + 1:].unsqueeze(1)
+    log_w = cs_end - cs[1:].unsqueeze(0)
+    pos = torch.arange(2 * b_size, device=delta.device)
+    row = torch.arange(b_size, device=delta.device).unsqueeze(-1)
+    window = (pos > row) & (pos <= row + b_size)
+    weight_d = torch.exp(log_w.masked_fill(~window.unsqueeze(-1), float('-inf')))
 
-    v_new = (weight_d * v_prev).sum(1)
+    v_new = (torch.exp(cs[b_size + 1:] - cs[1:b_size + 1]) * v_p +
+             (weight_d * beta2).sum(1))
 
     alpha_p = alpha
     beta_p = beta
 
-    vp = torch.cat((v_p[-1].unsqueeze(0), v_new[:-1]), 0)
+    vp = shift_stream(v_p[-1], v_new)
 
-    return delta - vp.view(b_size, num_features, 1, 1) * (1 - abkw) * out, v_new, alpha_p, beta_p
+    return delta - channel_view(vp.to(delta.dtype)) * (1 - abkw) * out, v_new, alpha_p, beta_p
+
+
+def normalize(input, mu, rscale, weight=None, bias=None):
+    """
+    Helper function for normalizing the input and applying the optional
+    affine transform
+    (x - mu) * rscale * weight + bias
+    in a single pass over the activation. The mean is subtracted before
+    scaling, folding it into a shift would cancel catastrophically when
+    |mu| >> std. The function is pure pointwise math so it can be compiled
+    into a single fused kernel. The math runs in the precision of the
+    statistics and the result is cast to the dtype of the input so reduced
+    precision activations stay that way.
+
+    Arguments:
+        input: input of size :math:`(N, C, H, W)`
+        mu: mean to subtract of size :math:`(N, C, 1, 1)`
+        rscale: reciprocal standard deviation of size :math:`(N, C, 1, 1)`
+        weight: optional affine scale of size :math:`(C)`
+        bias: optional affine shift of size :math:`(C)`
+
+    Return:
+        normalized input
+    """
+    scale = rscale
+    if weight is not None:
+        scale = scale * channel_view(weight)
+    centered = input - mu
+    if bias is None:
+        out = centered * scale
+    else:
+        out = torch.addcmul(channel_view(bias), centered, scale)
+    return out.to(input.dtype)
+
+
+def no_autocast(device_type):
+    """
+    Returns a context which disables autocast for device_type if it is
+    active and does nothing otherwise, so device types autocast does not
+    support are never handed to torch.autocast.
+    """
+    try:
+        enabled = torch.is_autocast_enabled(device_type)
+    except TypeError:
+        # torch < 2.4 only reports the cuda and cpu autocast state
+        enabled = {'cuda': torch.is_autocast_enabled,
+                   'cpu': torch.is_autocast_cpu_enabled}.get(device_type,
+                                                             lambda: False)()
+    if enabled:
+        return torch.autocast(device_type, enabled=False)
+    return contextlib.nullcontext()
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_normalize():
+    """
+    Returns normalize compiled with torch.compile. Compiled once on first use
+    and shared by all modules so the module itself holds no compiled state.
+    """
+    return torch.compile(normalize, fullgraph=True)
 
 
 class ControlNorm2D(nn.Module):
@@ -329,6 +481,14 @@ class ControlNorm2D(nn.Module):
     along the batch dimension and use convolutions in place of sums to
     distribute the computation across compute fabric.
 
+    An optional per-channel ``weight`` and ``bias`` can be passed to forward
+    in which case the affine transform is applied in the same pass over the
+    activation as the normalization.
+
+    Reduced precision inputs (e.g. float16 or bfloat16 under autocast) are
+    normalized in their own dtype while the streaming statistics and control
+    variables are tracked in the dtype of the module's buffers.
+
     Args:
         num_features: :math:`L` from an expected input of size :math:`(N, L)`
         eps: a value added to the denominator for numerical stability.
@@ -339,10 +499,13 @@ class ControlNorm2D(nn.Module):
             propagating through the network. Default: 0.99
         b_size (N): in order to speed up computation we need to know and fix the
             batch size a priori.
+        compile_ops: a boolean value that when set to ``True`` the pointwise
+            normalization is compiled with ``torch.compile`` into a single
+            fused kernel. Default: ``False``
 
     Shape:
         - Input: :math:`(N, C, H, W)`
-        - Output: :math:`(N, C, H, W)` (same shape as input)
+        - Output: :math:`(N, C, H, W)` (same shape and memory format as input)
 
     Examples::
 
@@ -353,8 +516,21 @@ class ControlNorm2D(nn.Module):
     __constants__ = ['m', 'var', 'u', 'v', 'm_p', 'var_p', 'u_p', 'v_p',
                      'beta_p', 'alpha_p', 'afwd', 'abkw', 'eps']
 
+    _state_names = ('m', 'var', 'm_p', 'var_p',
+                    'u', 'u_p', 'v_p', 'alpha_p', 'beta_p')
+
+    m = property(lambda self: self.state[0])
+    var = property(lambda self: self.state[1])
+    m_p = property(lambda self: self.state[2])
+    var_p = property(lambda self: self.state[3])
+    u = property(lambda self: self.state[4])
+    u_p = property(lambda self: self.state[5])
+    v_p = property(lambda self: self.state[6])
+    alpha_p = property(lambda self: self.state[7])
+    beta_p = property(lambda self: self.state[8])
+
     def __init__(self, num_features, alpha_fwd=0.999, alpha_bkw=0.99,
-                 eps=1e-05, b_size=None, **kwargs):
+                 eps=1e-05, b_size=None, compile_ops=False, **kwargs):
         super(ControlNorm2D, self).__init__()
         assert isinstance(b_size, int), 'b_size must be an integer'
         assert b_size > 0, 'b_size must be greater than 0'
@@ -365,40 +541,37 @@ class ControlNorm2D(nn.Module):
         self.afwd = alpha_fwd
         self.abkw = alpha_bkw
 
+        self.compile_ops = compile_ops
+
+        range_b = torch.arange(b_size - 1, -1, -1, dtype=torch.float32)
+
         # batch streaming parameters fpass
-        self.af_pow = None
-        self.af_batch = None
+        self.register_buffer('af_pow', (alpha_fwd ** range_b).view(1, 1, -1),
+                             persistent=False)
+        self.register_buffer('af_batch',
+                             torch.full([b_size, num_features],
+                                        alpha_fwd ** b_size),
+                             persistent=False)
 
         # batch streaming parameters bpass
-        self.ab_pow = None
-        self.ab_batch = None
-
+        self.register_buffer('ab_pow', (alpha_bkw ** range_b).view(1, 1, -1),
+                             persistent=False)
+        self.register_buffer('ab_batch',
+                             torch.full([b_size, num_features],
+                                        alpha_bkw ** b_size),
+                             persistent=False)
+
+        # all streaming state lives in one contiguous buffer and is accessed
+        # through the named views below (see self._state_names)
         # self.m and self.var are the streaming mean and variance respectively
-        self.register_buffer('m', torch.zeros([b_size, num_features]))
-        self.register_buffer('var', torch.ones([b_size, num_features]))
-        self.register_buffer('m_p', torch.zeros([b_size, num_features]))
-        self.register_buffer('var_p', torch.ones([b_size, num_features]))
-
-        # self.u and self.v are the control variables respectively
-        self.register_buffer('u', torch.zeros([b_size, num_features]))
-        self.register_buffer('u_p', torch.zeros([b_size, num_features]))
-        self.register_buffer('v_p', torch.zeros([b_size, num_features]))
-        self.register_buffer('beta_p', torch.zeros([b_size, num_features]))
-        self.register_buffer('alpha_p', torch.ones([b_size, num_features]))
+        # self.u and self.v_p are the control variables respectively
+        self.register_buffer('state', torch.zeros([len(self._state_names),
+                                                   b_size, num_features]))
         self.init_norm_params()
 
         class ControlNormalization(torch.autograd.Function):
             @staticmethod
-            def forward(ctx, input):
-                if self.af_pow is None:
-                    range_b = torch.arange(self.b_size - 1, -1, -1).type(input.type())
-                    self.af_pow = (self.afwd ** range_b).view(1, 1, -1)
-                    self.af_batch = input.new_full((self.b_size, num_features),
-                                                   self.afwd ** self.b_size)
-                    self.ab_pow = (self.abkw ** range_b).view(1, 1, -1)
-                    self.ab_batch = input.new_full((self.b_size, num_features),
-                                                   self.abkw ** self.b_size)
-
+            def forward(ctx, input, weight=None, bias=None):
                 momentum = self.afwd
                 momentum_pow = self.af_pow
                 momentum_batch = self.af_batch
@@ -413,21 +586,41 @@ class ControlNorm2D(nn.Module):
                                              momentum, momentum_pow,
                                              momentum_batch)
 
-                scale = torch.sqrt(_var_b + self.eps).unsqueeze(-1).unsqueeze(-1)
-                out = (input - _mu_b.unsqueeze(-1).unsqueeze(-1)) / scale
-                ctx.save_for_backward(out, scale)
+                _mu_b = channel_view(_mu_b)
+                rscale = channel_view(torch.rsqrt(_var_b + self.eps))
+                out = self.normalize(input, _mu_b, rscale, weight, bias)
+                ctx.save_for_backward(input, _mu_b, rscale, weight)
+                ctx.bias_dtype = None if bias is None else bias.dtype
 
-                self.m_p.data = mu.clone()
-                self.var_p.data = var_current.clone()
+                self.m_p.copy_(mu)
+                self.var_p.copy_(var_current)
 
-                self.m.data = mu_b.clone()
-                self.var.data = var_b.clone()
+                self.m.copy_(mu_b)
+                self.var.copy_(var_b)
 
                 return out
 
             @staticmethod
             def backward(ctx, grad_in):
-                out, scale, = ctx.saved_tensors
+                # backward may be run inside an autocast region on cpu
+                with no_autocast(grad_in.device.type):
+                    return ControlNormalization.control(ctx, grad_in)
+
+            @staticmethod
+            def control(ctx, grad_in):
+                input, _mu_b, rscale, weight, = ctx.saved_tensors
+                bias_dtype = ctx.bias_dtype
+                out = self.normalize(input, _mu_b, rscale)
+
+                # affine transform
+                grad_weight = grad_bias = None
+                if ctx.needs_input_grad[1]:
+                    grad_weight = (grad_in * out).sum(dim=(0, 2, 3),
+                                                      dtype=weight.dtype)
+                if ctx.needs_input_grad[2]:
+                    grad_bias = grad_in.sum(dim=(0, 2, 3), dtype=bias_dtype)
+                if weight is not None:
+                    grad_in = grad_in * channel_view(weight.to(grad_in.dtype))
 
                 # v controller
                 lin_ctrl_out = lin_crtl(grad_in, out,
@@ -435,20 +628,23 @@ class ControlNorm2D(nn.Module):
                                         self.v_p, self.alpha_p, self.beta_p,
                                         abkw=self.abkw, eps=1e-5)
 
-                (grad_delta, self.v_p.data,
-                 self.alpha_p.data, self.beta_p.data) = lin_ctrl_out
+                grad_delta, v_p, alpha_p, beta_p = lin_ctrl_out
+                self.v_p.copy_(v_p)
+                self.alpha_p.copy_(alpha_p)
+                self.beta_p.copy_(beta_p)
 
-                grad_delta = grad_delta / scale
+                grad_delta = grad_delta * rscale.to(grad_delta.dtype)
 
                 # mean (u) controller
                 u_tmp = self.mean(grad_delta)
 
                 _u_b, u_b = lin_momentum(self.u_p, u_tmp, self.u, self.abkw,
                                          self.ab_pow, self.ab_batch)
-                grad_delta = grad_delta - _u_b.unsqueeze(-1).unsqueeze(-1)
-                self.u_p.data, self.u.data = u_tmp.clone(), u_b.clone()
+                grad_delta = grad_delta - channel_view(_u_b.to(grad_delta.dtype))
+                self.u_p.copy_(u_tmp)
+                self.u.copy_(u_b)
 
-                return grad_delta
+                return grad_delta, grad_weight, grad_bias
 
         self.normalizer = ControlNormalization.apply
 
@@ -464,30 +660,111 @@ class ControlNorm2D(nn.Module):
         nn.init.constant_(self.beta_p, 0)
         nn.init.constant_(self.alpha_p, 1)
 
-    def moments(self, inputs):
-        n = inputs.size(2) * inputs.size(3)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # pack state dicts saved with one buffer per statistic
+        names = [prefix + name for name in self._state_names]
+        if prefix + 'state' not in state_dict and all(n in state_dict for n in names):
+            state_dict[prefix + 'state'] = torch.stack(
+                [state_dict.pop(n) for n in names])
+        super(ControlNorm2D, self)._load_from_state_dict(state_dict, prefix,
+                                                         *args, **kwargs)
 
-        mu = torch.sum(inputs, dim=(2, 3), keepdim=True) / n
-        mu0 = inputs - mu
-        return (mu.squeeze(),
-                torch.sum(mu0 * mu0, dim=(2, 3), keepdim=False) / n)
+    def moments(self, inputs):
+        # single pass Welford reduction over (H, W), stable for large H * W
+        # statistics are gathered in the precision of the streaming state
+        var, mu = torch.var_mean(inputs.to(self.state.dtype), dim=(2, 3),
+                                 correction=0)
+        return mu, var
 
     def mean(self, inputs):
-        n = inputs.size(2) * inputs.size(3)
-        return torch.sum(inputs, dim=(2, 3), keepdim=False) / n
+        return torch.mean(inputs, dim=(2, 3), dtype=self.state.dtype)
 
     def extra_repr(self):
         s = (f'num_features={self.num_features}, afwd={self.afwd}, '
              f'abkw={self.abkw}, eps={self.eps}')
         return s
 
-    def forward(self, input):
+    def normalize(self, input, mu, rscale, weight=None, bias=None):
+        # torch.compile can not trace into the autograd.Function so only the
+        # pure pointwise normalization is compiled
+        fn = compiled_normalize() if self.compile_ops else normalize
+        return fn(input, mu, rscale, weight, bias)
+
+    def forward(self, input, weight=None, bias=None):
         if self.training:
-            return self.normalizer(input)
-        mu = self.m[-1].unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-        var = self.var[-1].unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-        stddev = torch.sqrt(var + self.eps)
-        return (input - mu) / stddev
+            # keep autocast from lowering the precision of the statistics;
+            # activations are processed in the dtype of the input
+            with no_autocast(input.device.type):
+                return self.normalizer(input, weight, bias)
+        mu = channel_view(self.m[-1])
+        var = channel_view(self.var[-1])
+        rstddev = torch.rsqrt(var + self.eps)
+        return self.normalize(input, mu, rstddev, weight, bias)
+
+
+class SyncControlNorm2D(ControlNorm2D):
+    r"""Applies Control Normalization over a 4D input (a mini-batch of 3D
+    inputs) with the per sample statistics pooled across the processes of a
+    distributed group, so every process tracks the same streaming
+    statistics.
+
+    Sample ``i`` of the local batch is pooled with sample ``i`` of the batch
+    on every other process before it enters the streaming statistics. Mean
+    and second moment are packed into one buffer so each step costs a single
+    fixed size all_reduce. The control process of the backward pass stays
+    local. If ``torch.distributed`` is not initialized this layer behaves as
+    ``ControlNorm2D``.
+
+    Args:
+        num_features: :math:`L` from an expected input of size :math:`(N, L)`
+        eps: a value added to the denominator for numerical stability.
+            Default: 1e-5
+        alpha_fwd: the decay factor to be used in fprop to update statistics.
+            Default: 0.999
+        alpha_bkw: the decay factor to be used in fprop to control the gradients
+            propagating through the network. Default: 0.99
+        b_size (N): in order to speed up computation we need to know and fix the
+            per process batch size a priori.
+        process_group: the process group to pool statistics over. If None the
+            default process group is used. Default: None
+
+    Shape:
+        - Input: :math:`(N, C, H, W)`
+        - Output: :math:`(N, C, H, W)` (same shape and memory format as input)
+
+    Examples::
+
+        >>> norm = SyncControlNorm2D(256, 0.999, 0.99, b_size=32)
+        >>> onsync = OnlineNorm2D(256, ctrl_norm=norm)
+        >>> input = torch.randn(32, 256, 32, 32)
+        >>> output = onsync(input)
+    """
+    def __init__(self, num_features, alpha_fwd=0.999, alpha_bkw=0.99,
+                 eps=1e-05, b_size=None, process_group=None, **kwargs):
+        super(SyncControlNorm2D, self).__init__(num_features,
+                                                alpha_fwd=alpha_fwd,
+                                                alpha_bkw=alpha_bkw,
+                                                eps=eps, b_size=b_size,
+                                                **kwargs)
+        self.process_group = process_group
+
+    def moments(self, inputs):
+        mu, var = super(SyncControlNorm2D, self).moments(inputs)
+        if not (dist.is_available() and dist.is_initialized()):
+            return mu, var
+
+        # statistics only feed the streaming estimates inside the autograd
+        # Function so a plain (non differentiable) collective suffices
+        world_size = dist.get_world_size(self.process_group)
+
+        # center on the streaming mean, which every process shares, so the
+        # second moment does not cancel catastrophically when |mu| >> std
+        ref = self.m[-1]
+        shift = mu - ref
+        moments = torch.stack([shift, var + shift * shift])
+        dist.all_reduce(moments, group=self.process_group)
+        shift, moment2 = moments / world_size
+        return ref + shift, (moment2 - shift * shift).clamp_min(0)
 
 
 class OnlineNorm2D(nn.Module):
@@ -513,14 +790,15 @@ class OnlineNorm2D(nn.Module):
         bias: a boolean value that when set to ``True``, this module has
             learnable bias parameters. Default: ``True``
         ctrl_norm: control norm object layer. If None ControlNorm1D is selected.
-            Use if you want to select ``ControlNorm1DLoop``
+            Use if you want to select ``ControlNorm1DLoop`` or
+            ``SyncControlNorm2D``
             Default: None
         layer_scaling: a boolean value that when set to ``True``, this module has
             layer scaling at the end. Default: ``True``
 
     Shape:
         - Input: :math:`(N, C, H, W)`
-        - Output: :math:`(N, C, H, W)` (same shape as input)
+        - Output: :math:`(N, C, H, W)` (same shape and memory format as input)
 
     Examples::
 
@@ -576,13 +854,21 @@ class OnlineNorm2D(nn.Module):
                 f'bias={self.bias is not None}')
 
     def forward(self, input):
+        if isinstance(self.ctrl_norm, ControlNorm2D):
+            # apply control norm with the affine transform folded in
+            out = self.ctrl_norm(input, self.weight, self.bias)
+            return self.layer_scaling(out) if self.ls_op else out
         # apply control norm
         out = self.ctrl_norm(input)
-        # scale output
-        if self.weight is not None:
-            out = out * self.weight.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-        # add bias
-        if self.bias is not None:
-            out = out + self.bias.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
+        if self.weight is not None and self.bias is not None:
+            # scale output and add bias in one op
+            out = torch.addcmul(channel_view(self.bias), out,
+                                channel_view(self.weight))
+        elif self.weight is not None:
+            # scale output
+            out = out * channel_view(self.weight)
+        elif self.bias is not None:
+            # add bias
+            out = out + channel_view(self.bias)
         # apply layer scaling
         return self.layer_scaling(out) if self.ls_op else out
@@ -6,12 +6,85 @@ All rights reserved.
 
 This module tests the Online Normalization module
 """
+import importlib.util
+import os
+import tempfile
 import time
 import unittest
+from unittest import mock
 import logging
 import numpy as np
 import torch
-from online_norm_pytorch import OnlineNorm2D, ControlNorm2DLoop
+import torch.distributed as dist
+from online_norm_pytorch import (OnlineNorm2D, ControlNorm2D, ControlNorm2DLoop,
+                                 SyncControlNorm2D, LayerScaling)
+
+
+class ControlNorm2DReference(ControlNorm2DLoop):
+    """
+    Independent reference for the 2D control norms: the Online Normalization
+    algorithm stepped through one sample at a time exactly as written in the
+    paper. Shares no helpers with the implementations under test.
+    """
+    def __init__(self, num_features, **kwargs):
+        super(ControlNorm2DReference, self).__init__(num_features, **kwargs)
+
+        class ControlNormalization(torch.autograd.Function):
+            @staticmethod
+            def forward(ctx, input):
+                afwd = self.afwd
+                out = torch.empty_like(input)
+                scale = torch.empty_like(input[:, :, 0, 0])
+
+                n = input.size(2) * input.size(3)
+                mu = torch.sum(input, dim=(2, 3)) / n
+                mu0 = input - mu.unsqueeze(-1).unsqueeze(-1)
+                var = torch.sum(mu0 * mu0, dim=(2, 3)) / n
+
+                for idx in range(input.size(0)):
+                    # fprop activations
+                    scale[idx] = torch.sqrt(self.var + self.eps)
+                    _mu = self.m.unsqueeze(-1).unsqueeze(-1)
+                    _stddev = scale[idx].unsqueeze(-1).unsqueeze(-1)
+                    out[idx] = (input[idx] - _mu) / _stddev
+
+                    # Update statistics trackers
+                    self.var.data = (afwd * self.var +
+                                     (1 - afwd) * var[idx] +
+                                     (afwd * (1 - afwd) *
+                                      (mu[idx] - self.m) ** 2))
+                    self.m.data = self.m + (1 - afwd) * (mu[idx] - self.m)
+
+                ctx.save_for_backward(out.clone(), scale)
+                return out
+
+            @staticmethod
+            def backward(ctx, grad_out):
+                out, scale, = ctx.saved_tensors
+                abkw = self.abkw
+                grad_in = torch.empty_like(grad_out)
+                n = grad_out.size(2) * grad_out.size(3)
+
+                for idx in range(grad_out.size(0)):
+                    # ctrl grad_out with v controller
+                    grad_v_ctrl = (grad_out[idx] -
+                                   (1 - abkw) * self.v.unsqueeze(-1).unsqueeze(-1) * out[idx])
+
+                    # update v control variable
+                    self.v.data = self.v + torch.sum(grad_v_ctrl * out[idx], dim=(1, 2)) / n
+
+                    # scale delta
+                    grad_scaled = grad_v_ctrl / scale[idx].unsqueeze(-1).unsqueeze(-1)
+
+                    # ctrl grad_scaled with u controller
+                    grad_in[idx] = grad_scaled - (1 - abkw) * self.u.unsqueeze(-1).unsqueeze(-1)
+
+                    # Update control variables
+                    self.u.data = self.u + torch.sum(grad_in[idx], dim=(1, 2)) / n
+
+                return grad_in
+
+        self.normalizer = ControlNormalization.apply
 
 
 class TestStringMethods(unittest.TestCase):
@@ -23,14 +96,18 @@ class TestStringMethods(unittest.TestCase):
 
     def test010_similarity(self, b_size=4, dim=256,
                            alpha_fwd=0.999, alpha_bkw=0.99, eps=1e-05, itrs=4):
-        """ numerical comparison of online norm linearized vs loop """
+        """ numerical comparison of online norm implementations vs reference """
         # instantiate inputs
         input = torch.randn(b_size, dim, 32, 32)
-        input_0 = input.clone().detach().requires_grad_(True)
-        input_1 = input.clone().detach().requires_grad_(True)
+        input_ref = input.clone().detach().requires_grad_(True)
         # instantiate gradient at the output
         grad_out = torch.randn(b_size, dim, 32, 32)
 
+        # instantiate per sample reference Online Norm class
+        onref = OnlineNorm2D(dim, eps=eps,
+                             ctrl_norm=ControlNorm2DReference(dim, alpha_fwd=alpha_fwd,
+                                                              alpha_bkw=alpha_bkw, eps=eps))
+
         # instantiate Linearized Online Norm class
         onlin = OnlineNorm2D(dim, alpha_fwd=alpha_fwd, alpha_bkw=alpha_bkw, eps=eps, b_size=b_size)
 
@@ -38,35 +115,268 @@ class TestStringMethods(unittest.TestCase):
         onloop = OnlineNorm2D(dim, eps=eps,
                               ctrl_norm=ControlNorm2DLoop(dim, alpha_fwd=alpha_fwd,
                                                           alpha_bkw=alpha_bkw, eps=eps))
+        norms = [(onlin, input.clone().detach().requires_grad_(True)),
+                 (onloop, input.clone().detach().requires_grad_(True))]
 
         for _ in range(itrs):
-            # fprop through Linearized Online Norm class
-            y_0 = onlin(input_0)
-            # bprop through Linearized Online Norm class
+            # fprop and bprop through reference Online Norm class
+            y_ref = onref(input_ref)
+            y_ref.backward(grad_out)
+
+            for norm, input_0 in norms:
+                y_0 = norm(input_0)
+                y_0.backward(grad_out)
+
+                # numerically compare output
+                np.testing.assert_allclose(y_0.detach().numpy(),
+                                           y_ref.detach().numpy(),
+                                           rtol=1e-4, atol=1e-5)
+                # numerically grad_in
+                np.testing.assert_allclose(input_0.grad.detach().numpy(),
+                                           input_ref.grad.detach().numpy(),
+                                           rtol=1e-4, atol=1e-5)
+
+        self.logger.info('Algorithm implemented using linearization of ops '
+                         'numerically matches algorithm implemented with '
+                         'per sample loops')
+
+    @unittest.skipUnless(dist.is_available(), 'torch.distributed unavailable')
+    def test011_sync_similarity(self, b_size=4, dim=16,
+                                alpha_fwd=0.999, alpha_bkw=0.99, eps=1e-05,
+                                itrs=4):
+        """ numerical comparison of online norm synced over one process """
+        input = torch.randn(b_size, dim, 8, 8)
+        input_0 = input.clone().detach().requires_grad_(True)
+        input_1 = input.clone().detach().requires_grad_(True)
+        grad_out = torch.randn(b_size, dim, 8, 8)
+
+        # instantiate Linearized Online Norm class
+        onlin = OnlineNorm2D(dim, alpha_fwd=alpha_fwd, alpha_bkw=alpha_bkw,
+                             eps=eps, b_size=b_size)
+
+        # instantiate Synchronized Online Norm class
+        onsync = OnlineNorm2D(dim, eps=eps,
+                              ctrl_norm=SyncControlNorm2D(dim, alpha_fwd=alpha_fwd,
+                                                          alpha_bkw=alpha_bkw,
+                                                          eps=eps, b_size=b_size))
+
+        # destroy_process_group removes the file store itself so keep it
+        # in a directory which is cleaned up as a whole
+        with tempfile.TemporaryDirectory() as init_dir:
+            init_file = os.path.join(init_dir, 'store')
+            dist.init_process_group('gloo', init_method=f'file://{init_file}',
+                                    rank=0, world_size=1)
+            try:
+                for _ in range(itrs):
+                    y_0 = onlin(input_0)
+                    y_0.backward(grad_out)
+                    y_1 = onsync(input_1)
+                    y_1.backward(grad_out)
+
+                    # pooling over a single process must not change the result
+                    np.testing.assert_allclose(y_0.detach().numpy(),
+                                               y_1.detach().numpy(),
+                                               rtol=1e-4, atol=1e-5)
+                    np.testing.assert_allclose(input_0.grad.detach().numpy(),
+                                               input_1.grad.detach().numpy(),
+                                               rtol=1e-4, atol=1e-5)
+            finally:
+                dist.destroy_process_group()
+
+    @unittest.skipUnless(dist.is_available(), 'torch.distributed unavailable')
+    def test012_sync_pooling(self, b_size=4, dim=16, world_size=3):
+        """ pooled moments equal moments of the inputs of all processes """
+        # offset mean so a E[x^2] - mu^2 pooling would lose precision
+        inputs = [torch.randn(b_size, dim, 8, 8) + 1e3
+                  for _ in range(world_size)]
+
+        norm = ControlNorm2D(dim, b_size=b_size)
+        synced = SyncControlNorm2D(dim, b_size=b_size)
+
+        def all_reduce(tensor, group=None):
+            # process 0 is this process, others contribute their shifted
+            # moments about the shared streaming mean
+            ref = synced.m[-1]
+            for other in inputs[1:]:
+                mu, var = norm.moments(other)
+                shift = mu - ref
+                tensor.add_(torch.stack([shift, var + shift * shift]))
+
+        with mock.patch.object(dist, 'is_initialized', return_value=True), \
+                mock.patch.object(dist, 'get_world_size', return_value=world_size), \
+                mock.patch.object(dist, 'all_reduce', side_effect=all_reduce):
+            # streaming mean near the data as it is after warm up
+            synced.m.fill_(1e3)
+            mu, var = synced.moments(inputs[0])
+
+        # sample i of every process pooled is sample i of the inputs
+        # concatenated along W
+        mu_ref, var_ref = norm.moments(torch.cat(inputs, dim=3))
+        np.testing.assert_allclose(mu.numpy(), mu_ref.numpy(),
+                                   rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(var.numpy(), var_ref.numpy(),
+                                   rtol=1e-3, atol=1e-3)
+
+    def test013_single_channel(self, b_size=4, itrs=2):
+        """ statistics keep their (N, C) shape when C is 1 """
+        input = torch.randn(b_size, 1, 8, 8, requires_grad=True)
+
+        onlin = OnlineNorm2D(1, b_size=b_size)
+        onloop = OnlineNorm2D(1, ctrl_norm=ControlNorm2DLoop(1))
+
+        for norm in (onlin, onloop):
+            for _ in range(itrs):
+                out = norm(input)
+                out.sum().backward()
+                self.assertEqual(out.shape, input.shape)
+
+    def test014_channels_last(self, b_size=4, dim=16, itrs=2):
+        """ channels last inputs keep their layout and numerics """
+        input = torch.randn(b_size, dim, 8, 8)
+        input_0 = input.clone().detach().requires_grad_(True)
+        input_1 = input.clone().detach().to(
+            memory_format=torch.channels_last).requires_grad_(True)
+        grad_out = torch.randn(b_size, dim, 8, 8)
+
+        onlin_0 = OnlineNorm2D(dim, b_size=b_size)
+        onlin_1 = OnlineNorm2D(dim, b_size=b_size)
+
+        for _ in range(itrs):
+            y_0 = onlin_0(input_0)
+            y_0.backward(grad_out)
+            y_1 = onlin_1(input_1)
+            y_1.backward(grad_out.to(memory_format=torch.channels_last))
+
+            self.assertTrue(y_1.is_contiguous(memory_format=torch.channels_last))
+            np.testing.assert_allclose(y_0.detach().numpy(),
+                                       y_1.detach().numpy(),
+                                       rtol=1e-4, atol=1e-5)
+            np.testing.assert_allclose(input_0.grad.detach().numpy(),
+                                       input_1.grad.detach().numpy(),
+                                       rtol=1e-4, atol=1e-5)
+
+    def test015_layer_scaling_half(self, b_size=2, dim=128):
+        """ float16 layer scaling does not overflow the second moment """
+        input = torch.randn(b_size, dim, 32, 32)
+        ls = LayerScaling()
+
+        out = ls(input.half())
+
+        self.assertEqual(out.dtype, torch.float16)
+        self.assertTrue(torch.isfinite(out).all())
+        np.testing.assert_allclose(out.float().numpy(),
+                                   ls(input).numpy(),
+                                   rtol=1e-2, atol=1e-2)
+
+    def test016_layer_scaling_double(self, b_size=2, dim=16):
+        """ float64 layer scaling and online norm keep float64 """
+        input = torch.randn(b_size, dim, 8, 8, dtype=torch.float64)
+        ls = LayerScaling()
+
+        out = ls(input)
+
+        self.assertEqual(out.dtype, torch.float64)
+        np.testing.assert_allclose(out.numpy(),
+                                   ls(input.float()).double().numpy(),
+                                   rtol=1e-5, atol=1e-5)
+
+        norm = OnlineNorm2D(dim, b_size=b_size).double()
+        out = norm(input.requires_grad_(True))
+        out.sum().backward()
+        self.assertEqual(out.dtype, torch.float64)
+        self.assertEqual(input.grad.dtype, torch.float64)
+
+    @unittest.skipUnless(hasattr(torch, 'compile') and
+                         importlib.util.find_spec('torch._inductor') is not None,
+                         'torch.compile inductor backend unavailable')
+    def test017_compile_ops(self, b_size=4, dim=16, itrs=2):
+        """ compiled pointwise normalization matches eager """
+        input = torch.randn(b_size, dim, 8, 8)
+        input_0 = input.clone().detach().requires_grad_(True)
+        input_1 = input.clone().detach().requires_grad_(True)
+        grad_out = torch.randn(b_size, dim, 8, 8)
+
+        oneager = OnlineNorm2D(dim, b_size=b_size)
+        oncomp = OnlineNorm2D(dim, b_size=b_size, compile_ops=True)
+        self.assertIsInstance(oncomp.ctrl_norm, ControlNorm2D)
+
+        for _ in range(itrs):
+            y_0 = oneager(input_0)
             y_0.backward(grad_out)
-            # fprop through Looping Online Norm class
-            y_1 = onloop(input_1)
-            # bprop through Looping Online Norm class
+            y_1 = oncomp(input_1)
             y_1.backward(grad_out)
 
-            # numerically compare output
             np.testing.assert_allclose(y_0.detach().numpy(),
                                        y_1.detach().numpy(),
                                        rtol=1e-4, atol=1e-5)
-            # numerically grad_in
             np.testing.assert_allclose(input_0.grad.detach().numpy(),
                                        input_1.grad.detach().numpy(),
                                        rtol=1e-4, atol=1e-5)
 
-        self.logger.info('Algorithm implemented using linearization of ops '
-                         'numerically matches algorithm implemented with '
-                         'loops')
+        oneager.eval()
+        oncomp.eval()
+        with torch.no_grad():
+            np.testing.assert_allclose(oneager(input).numpy(),
+                                       oncomp(input).numpy(),
+                                       rtol=1e-4, atol=1e-5)
+
+    def test018_bfloat16(self, b_size=4, dim=16, itrs=2):
+        """ bfloat16 activations with float32 statistics """
+        input = torch.randn(b_size, dim, 8, 8)
+        input_0 = input.clone().detach().requires_grad_(True)
+        input_1 = input.clone().detach().bfloat16().requires_grad_(True)
+        grad_out = torch.randn(b_size, dim, 8, 8)
+
+        onlin_0 = OnlineNorm2D(dim, b_size=b_size)
+        onlin_1 = OnlineNorm2D(dim, b_size=b_size)
+
+        for _ in range(itrs):
+            y_0 = onlin_0(input_0)
+            y_0.backward(grad_out)
+            y_1 = onlin_1(input_1)
+            y_1.backward(grad_out.bfloat16())
+
+            self.assertEqual(y_1.dtype, torch.bfloat16)
+            self.assertEqual(input_1.grad.dtype, torch.bfloat16)
+            self.assertEqual(onlin_1.ctrl_norm.state.dtype, torch.float32)
+            self.assertEqual(onlin_1.weight.grad.dtype, torch.float32)
+            np.testing.assert_allclose(y_0.detach().numpy(),
+                                       y_1.detach().float().numpy(),
+                                       rtol=5e-2, atol=5e-2)
+            np.testing.assert_allclose(input_0.grad.detach().numpy(),
+                                       input_1.grad.detach().float().numpy(),
+                                       rtol=5e-2, atol=5e-2)
+        np.testing.assert_allclose(onlin_0.ctrl_norm.state.numpy(),
+                                   onlin_1.ctrl_norm.state.numpy(),
+                                   rtol=5e-2, atol=5e-2)
+
+        # the loop variant keeps activations in bfloat16 as well
+        norm = ControlNorm2DLoop(dim)
+        input_2 = input.clone().detach().bfloat16().requires_grad_(True)
+        y_2 = norm(input_2)
+        y_2.backward(grad_out.bfloat16())
+        self.assertEqual(y_2.dtype, torch.bfloat16)
+        self.assertEqual(input_2.grad.dtype, torch.bfloat16)
+        self.assertEqual(norm.var.dtype, torch.float32)
+
+    def test019_offset_mean(self, b_size=4, dim=16, offset=1e5):
+        """ normalization stays exact when |mean| >> std """
+        input = torch.randn(b_size, dim, 8, 8) + offset
+
+        norm = ControlNorm2D(dim, b_size=b_size).eval()
+        norm.m.fill_(offset)
+        norm.var.fill_(1)
+
+        out_ref = (input.double() - offset) / np.sqrt(1 + norm.eps)
+        np.testing.assert_allclose(norm(input).numpy(), out_ref.numpy(),
+                                   rtol=1e-5, atol=1e-5)
 
     def test020_speed(self, b_size=32, dim=256,
                       alpha_fwd=0.999, alpha_bkw=0.99, eps=1e-05, epoch=10):
         """
-        Speed test online norm linearized vs loop
-        Note: this test is for comparing speed to looped and linearized
+        Speed test online norm with ControlNorm2D vs ControlNorm2DLoop
+        Note: this test is for comparing speed of the fixed batch size
+            (ControlNorm2D) and any batch size (ControlNorm2DLoop)
             implementations of online norm so the user can decide which
             algorithm to use.
         """
@@ -95,26 +405,26 @@ class TestStringMethods(unittest.TestCase):
                          f'Total {(forward + backward) * 1e6/1e5:.3f} us')
 
         # Speed test online norm
-        # instantiate Looping Online Norm class
+        # instantiate any batch size Online Norm class
         onloop = OnlineNorm2D(dim, eps=eps,
                               ctrl_norm=ControlNorm2DLoop(dim, alpha_fwd=alpha_fwd,
                                                           alpha_bkw=alpha_bkw, eps=eps))
 
-        # time loop algo
+        # time ControlNorm2DLoop algo
         forward = 0
         backward = 0
         for _ in range(epoch):
             start = time.time()
-            # fprop through loop algo
+            # fprop through ControlNorm2DLoop algo
             out = onloop(input)
             forward += time.time() - start
 
             start = time.time()
-            # bprop through loop algo
+            # bprop through ControlNorm2DLoop algo
             out.sum().backward()
             backward += time.time() - start
 
-        self.logger.info(f'Loop Control Normalization Speed Test: '
+        self.logger.info(f'ControlNorm2DLoop Control Normalization Speed Test: '
                          f'Forward {forward * 1e6/1e5:.3f} us | '
                          f'Backward {backward * 1e6/1e5:.3f} us | '
                          f'Total {(forward + backward) * 1e6/1e5:.3f} us')